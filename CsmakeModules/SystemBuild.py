@@ -17,6 +17,8 @@
 # </copyright>
 from Csmake.CsmakeAspect import CsmakeModule
 import re
+import subprocess
+import threading
 
 class SystemBuild(CsmakeModule):
     """Purpose: Set up a system (computer/os install) build.
@@ -95,6 +97,35 @@ class SystemBuild(CsmakeModule):
             endvalue = sizeValue
         return endvalue
 
+    def _runSudoTasks(self, tasks, log):
+        #Runs each (function, args) in tasks, concurrently when sudo can
+        #  be used without a password, otherwise one after the other so
+        #  that several sudo calls never prompt on the terminal at once.
+        #  The functions must record their own outcome.
+        concurrent = False
+        if len(tasks) > 1:
+            #Validate sudo credentials once so the concurrent sudo calls
+            #  reuse the cached timestamp - never prompt here
+            result = subprocess.call(
+                ['sudo', '-n', '-v'],
+                stdout = log.out(),
+                stderr = log.err() )
+            if result == 0:
+                concurrent = True
+            else:
+                log.info("sudo could not be validated without a password (%d), running serially", result)
+        if not concurrent:
+            for function, args in tasks:
+                function(*args)
+            return
+        threads = [
+            threading.Thread(target=function, args=args)
+            for function, args in tasks ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
     def use_system_build(self, options):
         return self.build(options)
     def system_build(self, options):
@@ -16,8 +16,6 @@
 # </copyright>
 from CsmakeModules.SystemBuildGrubInstall import SystemBuildGrubInstall
 import os.path
-import subprocess
-import tempfile
 
 class SystemBuildEfiGrubInstall(SystemBuildGrubInstall):
     """Purpose: Install grub for UEFI
@@ -38,28 +36,47 @@ class SystemBuildEfiGrubInstall(SystemBuildGrubInstall):
     REQUIRED_OPTIONS = ['system', 'efi-directory']
 
     GRUB_TARGET_OPTION = ['--target', 'x86_64-efi']
-    #TODO: Make GRUB_OPTIONS dynamic from init, initialized from the static
-    GRUB_OPTIONS = ['-v', '--no-floppy', '--recheck', '--no-nvram']
+    GRUB_OPTIONS = ('-v', '--no-floppy', '--recheck', '--no-nvram')
+
+    #Complete grub-install option tuples, keyed on
+    #  (class, efi-directory, boot name)
+    _efiGrubOptions = {}
+
+    @classmethod
+    def _getEfiGrubOptions(cls, efiDirectory, bootName):
+        key = (cls, efiDirectory, bootName)
+        if key not in cls._efiGrubOptions:
+            cls._efiGrubOptions[key] = tuple(cls.GRUB_OPTIONS) + (
+                '--efi-directory', efiDirectory,
+                '--bootloader-id', bootName )
+        return cls._efiGrubOptions[key]
 
     def system_build(self, options):
         return self.build(options)
 
     def build(self, options):
-        self.GRUB_OPTIONS.extend(['--efi-directory', options['efi-directory']])
         bootName = 'boot'
         if 'boot-name' in options:
             bootName = options['boot-name']
-        self.GRUB_OPTIONS.extend(['--bootloader-id', bootName])
-        result = SystemBuildGrubInstall.build(self, options)
-        pathToEfi = os.path.join('/EFI', bootName, 'grubx64.efi')
+        #Shadow the class options with this call's options so repeated
+        #  builds don't keep growing the shared class level options
+        self.GRUB_OPTIONS = self._getEfiGrubOptions(
+            options['efi-directory'],
+            bootName )
+        self._efiBootName = bootName
+        return SystemBuildGrubInstall.build(self, options)
+
+    def _callGrubInstall(self):
+        if not SystemBuildGrubInstall._callGrubInstall(self):
+            return False
+        #Write startup.nsh as part of the install so a failure is reported
+        #  before the build is marked passed
+        pathToEfi = os.path.join('/EFI', self._efiBootName, 'grubx64.efi')
         pathToStartup = os.path.join(
             self.systemPartition,
-            options['efi-directory'].strip('/'),
+            self.options['efi-directory'].strip('/'),
             'startup.nsh')
-        with tempfile.NamedTemporaryFile(delete=False) as startup:
-            startup.write(pathToEfi)
-            filename = startup.name
-        result = subprocess.call(
-            ['sudo', 'mv', filename, pathToStartup],
-            stdout=self.log.out(),
-            stderr=self.log.err())
+        if not self._writeSystemFile(pathToStartup, pathToEfi):
+            self.log.failed()
+            return False
+        return True
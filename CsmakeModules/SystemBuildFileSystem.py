@@ -17,6 +17,8 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 # </copyright>
 from Csmake.CsmakeModule import CsmakeModule
+import os
+import re
 import subprocess
 
 class SystemBuildFileSystem(CsmakeModule):
@@ -32,7 +34,7 @@ class SystemBuildFileSystem(CsmakeModule):
                     a disk, partition or logical vol using the names provided
                        by the appropriate SystemBuild section
                     a filesystem, e.g., ext2, ext4, btrfs
-                       This will be the -t parameter to mkfs.
+                       mkfs.<filesystem> will be used to create it.
        Example:
            [SystemBuildFileSystem@myfilesystem]
            system = mysystem
@@ -58,6 +60,23 @@ class SystemBuildFileSystem(CsmakeModule):
 
     REQUIRED_OPTIONS = ['system', '/']
 
+    #The filesystem type becomes part of the mkfs.<type> command name
+    FSTYPE_FORMAT = re.compile(r'^[A-Za-z0-9_]+$')
+
+    #Option used to label the filesystem at creation time with mkfs.<type>
+    #  Filesystems not listed are labeled by their _LABELERS entry
+    #  after mkfs completes.  mkfs fails on a label it cannot use, so
+    #  the labelers return labels cut down to what each type accepts.
+    MKFS_LABEL_OPTIONS = {
+        'ext2' : '-L',
+        'ext3' : '-L',
+        'ext4' : '-L',
+        'btrfs' : '-L',
+        'vfat' : '-n',
+        'fat' : '-n',
+        'jfs' : '-L',
+        'xfs' : '-L' }
+
     def _getEnvKey(self, system):
         return "__SystemBuild_%s__" % system
 
@@ -84,12 +103,16 @@ class SystemBuildFileSystem(CsmakeModule):
         systemEntry['filesystem'] = fsEntry
         fsinfoEntry = {}
         systemEntry['filesystem-info'] = fsinfoEntry
-        mountpts = [ x for x in options.keys() if x[0] == '/']
-        mountpts.sort(key=lambda x: len(x.split('/')))
+        mountpts = sorted(
+            [ x for x in options if x.startswith('/') ],
+            key=lambda x: x.count('/') )
+        disks = systemEntry['disks']
         fsoptions = []
+        jobs = []
         for mountpt in mountpts:
+            spec = options[mountpt]
             try:
-                parts = options[mountpt].split(',')
+                parts = spec.split(',')
                 if len(parts) == 2:
                     csmakedevice, fstype = parts
                     fsoptions = []
@@ -103,7 +126,7 @@ class SystemBuildFileSystem(CsmakeModule):
                     "Filesystem spec was invalid (%s): '%s=%s'",
                     str(e),
                     mountpt,
-                    options[mountpt])
+                    spec)
                 self.log.failed()
                 return None
 
@@ -115,58 +138,169 @@ class SystemBuildFileSystem(CsmakeModule):
             else:
                 diskname = csmakedevice
             fstype = fstype.strip()
-            if diskname not in systemEntry['disks']:
+            if self.FSTYPE_FORMAT.match(fstype) is None:
+                self.log.error(
+                    "Filesystem type '%s' for mount point '%s' is invalid",
+                    fstype,
+                    mountpt )
+                self.log.failed()
+                return None
+            diskEntry = disks.get(diskname)
+            if diskEntry is None:
                 self.log.error(
                     "Device '%s' for mount point '%s' undefined",
                     diskname,
                     mountpt )
                 self.log.failed()
                 return None
-            diskEntry = systemEntry['disks'][diskname]
             device = diskEntry['device']
             fsinfoEntry[mountpt] = { 'disk' : diskEntry, 'partition' : None }
             fslabel = diskname
             fstabTarget = diskEntry
             if partname is not None:
-                partEntry = diskEntry['partitions']
-                if partname not in partEntry:
+                partEntry = diskEntry.get('partitions', {}).get(partname)
+                if partEntry is None:
                     self.log.error(
                         "Partition '%s' for disk '%s' undefined",
                         partname,
                         diskname )
                     self.log.failed()
                     return None
-                device = partEntry[partname]['device']
-                fsinfoEntry[mountpt]['partition'] = partEntry[partname]
+                device = partEntry['device']
+                fsinfoEntry[mountpt]['partition'] = partEntry
                 fslabel = partname
-                fstabTarget = partEntry[partname]
-            if build:
-                subprocess.check_call(
-                    ['sudo', 'mkfs', '-t', fstype] + fsoptions + [device],
-                    stdout = self.log.out(),
-                    stderr = self.log.err() )
+                fstabTarget = partEntry
+            jobs.append({
+                'mountpt' : mountpt,
+                'disk' : diskEntry['device'],
+                'device' : device,
+                'fstype' : fstype,
+                'fsoptions' : fsoptions,
+                'fslabel' : fslabel,
+                'fstabTarget' : fstabTarget })
+
+        if build:
+            self._createFileSystemsInParallel(
+                systemEntry['system'], jobs, build)
+        else:
+            self._createFileSystems(jobs, build)
+
+        for job in jobs:
+            if 'error' in job:
+                raise job['error']
+            mountpt = job['mountpt']
+            fstabTarget = job['fstabTarget']
+            if 'label-error' in job:
+                self.log.error(
+                    "Failed to label filesystem (%s) - the booted image may not be able to find: %s",
+                    str(job['label-error']),
+                    mountpt )
+            elif 'label' in job:
+                if job['label'] is not None:
+                    fstabTarget['fstab-id'] = "LABEL=%s" % job['label']
+                else:
+                    self.log.warning("Failed to label filesystem - the booted image may not be able to find: %s", mountpt)
+            fsEntry[mountpt] = (
+                mountpt,
+                job['device'],
+                job['fstype'],
+                fstabTarget['fstab-id'] )
+        if build:
+            self._syncDevices([ job['device'] for job in jobs ])
+        self.log.passed()
+        return fsEntry
+
+    def _syncDevices(self, devices):
+        #Flush just the devices that were written instead of every
+        #  dirty page on the host
+        unsynced = []
+        for device in devices:
+            try:
+                fd = os.open(device, os.O_RDONLY)
+                try:
+                    os.fdatasync(fd)
+                finally:
+                    os.close(fd)
+            except OSError:
+                unsynced.append(device)
+        if len(unsynced) > 0:
+            #sync will fsync just the given files, older versions
+            #  ignore the arguments and fall back to a full sync
+            subprocess.call(
+                ['sudo', 'sync'] + unsynced,
+                stdout = self.log.out(),
+                stderr = self.log.err() )
+
+    def _createFileSystemsInParallel(self, systemInstance, jobs, build):
+        #Filesystems on different disks are created concurrently,
+        #  filesystems that share a disk are created one after the other
+        diskJobs = {}
+        disks = []
+        for job in jobs:
+            if job['disk'] not in diskJobs:
+                diskJobs[job['disk']] = []
+                disks.append(job['disk'])
+            diskJobs[job['disk']].append(job)
+        systemInstance._runSudoTasks(
+            [ (self._createFileSystems, (diskJobs[disk], build))
+              for disk in disks ],
+            self.log )
+
+    def _createFileSystems(self, jobs, build):
+        #Runs mkfs and the labeler for each job, recording the outcome
+        #  on the job itself, so it is safe to call from a worker thread.
+        for job in jobs:
+            fstype = job['fstype']
+            device = job['device']
 
             #Only try labeling if we haven't already provided an fstab id
             #TODO: Consider attempting to get the UUID
             #TODO: Add fstab parms
             #TODO: Add swap...
-            if '=' not in fstabTarget['fstab-id']:
-                labeler = "_labelFileSystem_%s" % fstype
-                if hasattr(self, labeler):
-                    try:
-                        newlabel = getattr(self, labeler)(fslabel, device, build)
-                        if newlabel is not None:
-                            fstabTarget['fstab-id'] = "LABEL=%s" % newlabel
-                        else:
-                            self.log.warning("Failed to label filesystem - the booted image may not be able to find: %s", mountpt)
-                    except:
-                        self.log.exception("Failed to label filesystem - the booted image may not be able to find: %s", mountpt)
-            fsEntry[mountpt] = (mountpt, device, fstype, fstabTarget['fstab-id'])
-        subprocess.call(['sync'])
-        self.log.passed()
-        return fsEntry
+            labeler = None
+            if '=' not in job['fstabTarget']['fstab-id'] \
+                    and fstype in self._LABELERS:
+                labeler = getattr(self, self._LABELERS[fstype])
+
+            #When mkfs can apply the label itself, only ask the labeler
+            #  for the (possibly adjusted) label and hand it to mkfs
+            labelOptions = []
+            if build and labeler is not None \
+                    and fstype in self.MKFS_LABEL_OPTIONS:
+                try:
+                    job['label'] = labeler(
+                        job['fslabel'], device, False)
+                    if job['label'] is not None:
+                        labelOptions = [
+                            self.MKFS_LABEL_OPTIONS[fstype],
+                            job['label'] ]
+                except Exception as e:
+                    job['label-error'] = e
+                labeler = None
+
+            if build:
+                try:
+                    subprocess.check_call(
+                        ['sudo', 'mkfs.%s' % fstype] + labelOptions \
+                            + job['fsoptions'] + [device],
+                        stdout = self.log.out(),
+                        stderr = self.log.err() )
+                except Exception as e:
+                    job['error'] = e
+                    return
+
+            if labeler is not None:
+                try:
+                    job['label'] = labeler(
+                        job['fslabel'], device, build)
+                except Exception as e:
+                    job['label-error'] = e
 
-    #To add more supported file systems, subclass and add more _labelFileSystem
+    #To add more supported file systems, subclass, add more _labelFileSystem
+    #  methods and extend a copy of _LABELERS with their names, e.g.:
+    #     _LABELERS = dict(SystemBuildFileSystem._LABELERS,
+    #                      zfs='_labelFileSystem_zfs')
+    #  Overriding an existing _labelFileSystem method needs no registration
     def _labelFileSystem_ext2(self, fslabel, device, build):
         return self._labelFileSystem_ext(fslabel, device, build)
     def _labelFileSystem_ext3(self, fslabel, device, build):
@@ -175,6 +309,7 @@ class SystemBuildFileSystem(CsmakeModule):
         return self._labelFileSystem_ext(fslabel, device, build)
 
     def _labelFileSystem_ext(self, fslabel, device, build):
+        fslabel = fslabel[:16]
         if build:
             subprocess.check_call(
                 ['sudo', 'e2label', device, fslabel],
@@ -210,6 +345,7 @@ class SystemBuildFileSystem(CsmakeModule):
         return fslabel
 
     def _labelFileSystem_jfs(self, fslabel, device, build):
+        fslabel = fslabel[:16]
         if build:
             subprocess.check_call(
                 ['sudo', 'jfs_tune', '-L', fslabel, device],
@@ -218,9 +354,25 @@ class SystemBuildFileSystem(CsmakeModule):
         return fslabel
 
     def _labelFileSystem_xfs(self, fslabel, device, build):
+        fslabel = fslabel[:12]
         if build:
             subprocess.check_call(
                 ['sudo', 'xfs_admin', '-L', fslabel, device],
                 stdout=self.log.out(),
                 stderr=self.log.err())
         return fslabel
+
+    #Name of the labeling method to use for each filesystem type
+    #  The method is looked up on the instance so subclass overrides apply
+    #  This is shared by every instance (and subclass), never modify it
+    #  in place.
+    _LABELERS = {
+        'ext2' : '_labelFileSystem_ext2',
+        'ext3' : '_labelFileSystem_ext3',
+        'ext4' : '_labelFileSystem_ext4',
+        'btrfs' : '_labelFileSystem_btrfs',
+        'vfat' : '_labelFileSystem_vfat',
+        'fat' : '_labelFileSystem_fat',
+        'NTFS' : '_labelFileSystem_NTFS',
+        'jfs' : '_labelFileSystem_jfs',
+        'xfs' : '_labelFileSystem_xfs' }
@@ -43,15 +43,26 @@ class SystemBuildGetPartitionDevices(CsmakeAspect):
     """
     REQUIRED_OPTIONS = [ 'system' ]
 
+    def __init__(self, env, log):
+        CsmakeAspect.__init__(self, env, log)
+        self._envvarsOptions = None
+        self._envvars = ()
+
     def _getEnvKey(self, system):
         return "__SystemBuild_%s__" % system
 
     def _getEnvironmentVariables(self):
+        #The same options are handed to every joinpoint for a section
+        #  so only scan them again when they change.
+        if self._envvarsOptions is self.options:
+            return self._envvars
         results = []
-        for option, envvar in self.options.iteritems():
+        for option, envvar in self.options.items():
             if option.startswith('env_'):
-                results.append((option.lstrip('env_'), envvar))
-        return results
+                results.append((option[4:], envvar))
+        self._envvarsOptions = self.options
+        self._envvars = tuple(results)
+        return self._envvars
 
     def start(self, phase, options, step, stepoptions):
         if phase == 'build' or phase == 'system_build':
@@ -70,8 +81,9 @@ class SystemBuildGetPartitionDevices(CsmakeAspect):
         self.options = options
         envvars = self._getEnvironmentVariables()
         for _, env in envvars:
-            if env in self.env.env:
-                del self.env.env[env]
+            self.env.env.pop(env, None)
+        self._envvarsOptions = None
+        self._envvars = ()
         self.log.passed()
         return None
 
@@ -87,19 +99,20 @@ class SystemBuildGetPartitionDevices(CsmakeAspect):
     def start__build(self, phase, options, step, stepoptions):
         self.options = options
         envvars = self._getEnvironmentVariables()
-        try:
-            system = self.env.env[self._getEnvKey(self.options['system'])]
-        except KeyError:
+        system = self.env.env.get(self._getEnvKey(self.options['system']))
+        if system is None:
             self.log.error("System '%s' could not be found", self.options['system'])
             self.log.failed()
             return None
+        filesystem = system.get('filesystem')
+        if filesystem is None and len(envvars) > 0:
+            self.log.error("The filesystem for the SystemBuild is not yet defined")
+            self.log.failed()
+            return
         for mpt, env in envvars:
-            if 'filesystem' not in system:
-                self.log.error("The filesystem for the SystemBuild is not yet defined")
-                self.log.failed()
-                return
-            if mpt in system['filesystem']:
-                system_mpt, device, _, _ = system['filesystem'][mpt]
+            fsentry = filesystem.get(mpt)
+            if fsentry is not None:
+                system_mpt, device, _, _ = fsentry
                 if env in self.env.env:
                     self.log.warning("Overwriting environment '%s'", env)
                 self.env.env[env] = device
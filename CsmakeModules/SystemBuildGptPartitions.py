@@ -18,6 +18,7 @@
 # </copyright>
 from CsmakeModules.SystemBuildMsdosPartitions import SystemBuildMsdosPartitions
 import subprocess
+import re
 
 class SystemBuildGptPartitions(SystemBuildMsdosPartitions):
     """Purpose: Set up partitions on a disk for a system build.
@@ -35,8 +36,8 @@ class SystemBuildGptPartitions(SystemBuildMsdosPartitions):
                    <order>, <size>, <type>[, <flags>]
                    order - position on the disk
                    size - Size of the partition in G or M
-                          Sizes are suggestions with size being within
-                          1% of the size of the disk and optimazations
+                          Sizes are rounded up to a whole MiB and
+                          the last partition is truncated to fit the disk
                    type - number or hex number or guid (e.g., 0x84)
                           or a defined type (e.g., Linux)
                           defined types are (per parted):
@@ -82,11 +83,32 @@ class SystemBuildGptPartitions(SystemBuildMsdosPartitions):
     PART_TYPE = "gpt"
     PART_PRIMARY_PARTITIONS = 128
     PART_LOGICAL_EXTENDED_ALLOWED = False
+    PART_NAMES_ALLOWED = True
+    #Keep clear of the backup GPT header and entries at the end of the disk
+    PART_RESERVED_END = 34
 
-    def _editPartitionWithSfdisk(self, device, number, partition):
+    #sgdisk accepts a (up to) 4 digit hex code, e.g. 8300, or a full GUID
+    GPT_TYPECODE_FORMAT = re.compile(
+        r'^((0x)?[0-9A-Fa-f]{1,4}|'
+        r'[0-9A-Fa-f]{8}-[0-9A-Fa-f]{4}-[0-9A-Fa-f]{4}-'
+        r'[0-9A-Fa-f]{4}-[0-9A-Fa-f]{12})$')
+
+    def _commitPartitionTypes(self, device, partitions):
+        #sgdisk can set every type in one pass over the partition table
+        typecodes = []
+        for number, partition in partitions:
+            if self.GPT_TYPECODE_FORMAT.match(partition[3]) is None:
+                self.log.warning(
+                    "Partition type '%s' for '%s' is not a GPT type code or GUID",
+                    partition[3],
+                    partition[0] )
+                continue
+            typecodes.append('--typecode=%d:%s' % (number, partition[3]))
+        if len(typecodes) == 0:
+            return
         result = subprocess.call(
-            ['sudo', 'gfdisk', '--typecode=%d:%s' % (number, partition[3]), device],
-            stdout = self.log.out(),
-            stderr = self.log.err() )
+            ['sudo', 'sgdisk'] + typecodes + [device],
+            stdout = self.logOut,
+            stderr = self.logErr )
         if result != 0:
-            self.log.warning("Did not successfully set the requested partition type")
+            self.log.warning("Did not successfully set the requested partition types")
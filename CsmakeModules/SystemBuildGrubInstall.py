@@ -46,15 +46,68 @@ class SystemBuildGrubInstall(CsmakeModule):
         ''' Use sudo to change file permissions.  Returns old permissions
         mask.  Note that the new_perms_mask is a string.
         '''
-        assert(str == type(new_perms_mask))
-        old_stat = os.stat(filepath)
-        old_perms_mask = oct(old_stat[stat.ST_MODE])[-3:]
-        subprocess.check_call(["sudo", "chmod", new_perms_mask, filepath],
+        return self._sudo_change_files_perms(
+            [(filepath, new_perms_mask)])[0]
+
+    def _sudo_change_files_perms(self, changes):
+        ''' Use sudo to change the permissions of several files at once.
+        changes is a list of (filepath, new_perms_mask) pairs.
+        Returns the list of old permissions masks in the same order.
+        '''
+        old_perms_masks = []
+        for filepath, new_perms_mask in changes:
+            assert(str == type(new_perms_mask))
+            old_stat = os.stat(filepath)
+            old_perms_masks.append(oct(old_stat[stat.ST_MODE])[-3:])
+        if os.geteuid() == 0:
+            for filepath, new_perms_mask in changes:
+                os.chmod(filepath, int(new_perms_mask, 8))
+            return old_perms_masks
+        if len(changes) == 1:
+            filepath, new_perms_mask = changes[0]
+            command = ["sudo", "chmod", new_perms_mask, filepath]
+        else:
+            command = ["sudo", "sh", "-c",
+                'while [ $# -gt 0 ]; do chmod "$1" "$2" || exit 1; shift 2; done',
+                "chmod"]
+            for filepath, new_perms_mask in changes:
+                command.extend([new_perms_mask, filepath])
+        subprocess.check_call(command,
                                  stdout=self.log.out(),
                                  stderr=self.log.err())
         # If subprocess.check_call fails it will throw a CalledProcessError. We
         # choose to simply let that error propogate upwards.
-        return old_perms_mask
+        return old_perms_masks
+
+    def _writeSystemFile(self, path, contents):
+        #Replaces path with contents without opening up its permissions
+        if os.geteuid() == 0:
+            temppath = path + '.tmp'
+            fd = os.open(temppath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                try:
+                    #Keep the mode of the file being replaced
+                    if os.path.exists(path):
+                        os.fchmod(fd, stat.S_IMODE(os.stat(path).st_mode))
+                    os.write(fd, contents.encode())
+                finally:
+                    os.close(fd)
+                os.rename(temppath, path)
+            except:
+                os.unlink(temppath)
+                raise
+            return True
+        #Writing through sh keeps the contents out of the build log
+        writer = subprocess.Popen(
+            [ 'sudo', 'sh', '-c', 'cat > "$1"', 'sh', path ],
+            stdin=subprocess.PIPE,
+            stdout=self.log.out(),
+            stderr=self.log.err() )
+        writer.communicate(contents.encode())
+        if writer.returncode != 0:
+            self.log.error("Writing '%s' failed (%d)", path, writer.returncode)
+            return False
+        return True
 
     def _edit_default_grub(self, system_partition):
         ''' Edit grub default file. Find line starting with
@@ -211,7 +264,8 @@ class SystemBuildGrubInstall(CsmakeModule):
             pass
         result = subprocess.call(
             ["sudo", "chroot", self.systemPartition,
-                grub_install ] + self.GRUB_TARGET_OPTION + self.GRUB_OPTIONS + [ self.systemDevice ],
+                grub_install ] + list(self.GRUB_TARGET_OPTION) \
+                + list(self.GRUB_OPTIONS) + [ self.systemDevice ],
             stdout=self.log.out(),
             stderr=self.log.err())
         if result != 0:
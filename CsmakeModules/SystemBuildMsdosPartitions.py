@@ -19,6 +19,8 @@
 from Csmake.CsmakeModule import CsmakeModule
 import subprocess
 import re
+import os.path
+import time
 
 class SystemBuildMsdosPartitions(CsmakeModule):
     """Purpose: Set up partitions on a disk for a system build.
@@ -32,10 +34,10 @@ class SystemBuildMsdosPartitions(CsmakeModule):
                The fields for the entries are:
                    <order>, <size>, <type>[, <flags>]
                    order - position on the disk
-                           This is sorted in lexicigraphical order
-                           If you have more than 9 partitions, use
-                           01, 02, 03, ..., 10, 11, 12 to create the
-                           partitions.
+                           This is sorted in numerical order, so
+                           1, 2, ..., 10, 11 (or 01, 02, ...) may be used.
+                           Orders that aren't numbers are sorted
+                           after the numbered ones, as text.
                            These labels do not dictate the actual partition
                            numbers.  The partitions will be labeled
                            in order based on how the partitioning scheme
@@ -49,8 +51,8 @@ class SystemBuildMsdosPartitions(CsmakeModule):
                             partitions will start at 5 on the system regardless
                             of the numbers used for 'order')
                    size - Size of the partition in G or M
-                          Sizes are suggestions with size being within
-                          1% of the size of the disk and optimazations
+                          Sizes are rounded up to a whole MiB and
+                          the last partition is truncated to fit the disk
                    type - number or hex number (e.g., 0x84)
                           or a defined type (e.g., Linux)
                           defined types are (per parted):
@@ -117,28 +119,72 @@ class SystemBuildMsdosPartitions(CsmakeModule):
     PART_TYPE = "msdos"
     PART_PRIMARY_PARTITIONS = 4
     PART_LOGICAL_EXTENDED_ALLOWED = True
-    #Tell parted to start on sector 2048
-    PART_FIRST_START = "2048s"
+    #msdos partition tables cannot hold partition names
+    PART_NAMES_ALLOWED = False
+    #Partitions are placed on 1MiB boundaries (2048 512 byte sectors)
+    #  which also puts the first partition on sector 2048
+    PART_SECTOR_SIZE = 512
+    PART_ALIGNMENT = 2048
+    #Sectors at the end of the disk that partitions must not use
+    PART_RESERVED_END = 0
+    #Seconds to wait for partition devices to appear after partprobe
+    PART_DEVICE_TIMEOUT = 5
+    #Seconds to wait for udev to finish handling the new partitions
+    PART_SETTLE_TIMEOUT = 60
+    #Options defining partitions, part_<name>
+    PART_OPTION_FORMAT = re.compile(r'^part_\s*(\S.*?)\s*$')
+    #Partition order: <n>, <ex>E, or <ex>E:<logical>L
+    PART_ORDER_FORMAT = re.compile(r'^(\d+)(E(:(\d+)L)?)?$')
 
     def _getEnvKey(self, system):
         return "__SystemBuild_%s__" % system
 
-    def _getRequestedPercentage(self, size):
-        requestedSize = self.systemInstance._getSizeInBytes(size)
-        result = int(round(requestedSize*100.0/self.disksize))
-        if result == 0:
-            result = 1
+    def _parsePartitionOrder(self, order):
+        #Returns (sort key, kind) for a partition order
+        #  kind is 'P'rimary, 'E'xtended, 'L'ogical or None if malformed
+        #Numbered orders sort numerically with an extended partition
+        #  ahead of its logical partitions.  Anything else sorts as text
+        #  after them.
+        match = self.PART_ORDER_FORMAT.match(order)
+        if match is None:
+            kind = 'P'
+            if order.endswith('E') or order.endswith('L'):
+                kind = None
+            return ((1, 0, 0, order), kind)
+        logical = -1
+        kind = 'P'
+        if match.group(4) is not None:
+            logical = int(match.group(4))
+            kind = 'L'
+        elif match.group(2) is not None:
+            kind = 'E'
+        return ((0, int(match.group(1)), logical, order), kind)
+
+    def _getRequestedSectors(self, size):
+        if size not in self.sizeCache:
+            self.sizeCache[size] = self.systemInstance._getSizeInBytes(size)
+        requestedSize = self.sizeCache[size]
+        #Round up to whole alignment units so every partition stays aligned
+        unitSize = self.PART_ALIGNMENT * self.PART_SECTOR_SIZE
+        units = (requestedSize + unitSize - 1) // unitSize
+        if units == 0:
+            units = 1
             self.log.warning("The requested partition was too small (%s), the partition has been rounded up to the next available size", size)
-        return result
+        return units * self.PART_ALIGNMENT
 
     def _editPartitionWithSfdisk(self, device, number, partition):
         result = subprocess.call(
             ['sudo', 'sfdisk', '--part-type', device, "%d" % number, partition[3]],
-            stdout = self.log.out(),
-            stderr = self.log.err() )
+            stdout = self.logOut,
+            stderr = self.logErr )
         if result != 0:
             self.log.warning("Did not successfully set the requested partition type")
-        
+
+    def _commitPartitionTypes(self, device, partitions):
+        #partitions is a list of (number, partition) that need their type set
+        for number, partition in partitions:
+            self._editPartitionWithSfdisk(device, number, partition)
+
     #Structure of the partition is name, order, size, type, flag(boot)
     def _createNextPartition(
         self, device, number, parttype, partition, start, end):
@@ -152,64 +198,59 @@ class SystemBuildMsdosPartitions(CsmakeModule):
             else:
                 callsfdisk = True
             command_specifics = [ fstype ]
-        if start == 0:
-            startstr = self.PART_FIRST_START
-        else:
-            startstr = "%s%%" % start
-        subprocess.check_call(
-            ['sudo', 'parted', '-s', '-a', 'optimal', device, '--',
-              'mkpart', parttype] + command_specifics + [startstr, "%d%%" % end],
-            stdout=self.log.out(),
-            stderr=self.log.err() )
-        subprocess.call(
-            ['sudo', 'parted', '-s', device, '--', 'name', '%d' % number, partition[0]],
-            stdout = self.log.out(),
-            stderr = self.log.err())
-        if len(partition) > 4:
-            for flag in partition[4:]:
-                subprocess.check_call(
-                    ['sudo', 'parted', '-s', device, '--',
-                     'set', "%d" % number, flag, 'on'],
-                    stdout = self.log.out(),
-                    stderr = self.log.err())
+        #start and end are sectors, end is exclusive, parted's is inclusive
+        #The commands are run by a single parted call in _doPartitioning
+        self.partedCommands.extend(
+            ['mkpart', parttype] + command_specifics \
+                + ["%ds" % start, "%ds" % (end - 1)])
+        if self.PART_NAMES_ALLOWED:
+            self.partedCommands.extend(['name', '%d' % number, partition[0]])
+        for flag in partition[4:]:
+            self.partedCommands.extend(['set', '%d' % number, flag, 'on'])
         if callsfdisk:
-            self._editPartitionWithSfdisk(device, number, partition)
+            self.customTypes.append((number, partition))
         if fstype == 'linux-swap':
-            self.swaps.append((device, number, partition))
+            self.swaps.append(partition[0])
 
     def _createPrimaryPartition(self, device, number, partition):
-        requestedPercent = self._getRequestedPercentage(partition[2])
-        start = self.startPercent
-        end = start + requestedPercent
-        if end > 100:
-            self.log.warning("Primary partition was truncated, %d%% beyond the end of the disk", end-100)
-            end = 100
+        start = self.startSector
+        end = start + self._getRequestedSectors(partition[2])
+        if end > self.diskEnd:
+            self.log.warning("Primary partition was truncated, %d sectors beyond the end of the disk", end - self.diskEnd)
+            end = self.diskEnd
+        if start >= end:
+            raise ValueError("No space left on the disk")
         self._createNextPartition(
             device, number, 'primary', partition, start, end)
-        self.startPercent = end
+        self.startSector = end
 
     def _createExtendedPartition(self, device, number, partition):
-        requestedPercent = self._getRequestedPercentage(partition[2])
-        start = self.startPercent
-        end = start + requestedPercent
-        if end > 100:
-            self.log.warning("Extended partition was truncated, %d%% beyond the end of the disk", 100-end)
-            end = 100
+        start = self.startSector
+        end = start + self._getRequestedSectors(partition[2])
+        if end > self.diskEnd:
+            self.log.warning("Extended partition was truncated, %d sectors beyond the end of the disk", end - self.diskEnd)
+            end = self.diskEnd
+        if start >= end:
+            raise ValueError("No space left on the disk")
         self._createNextPartition(
             device, number, 'extended', partition, start, end)
         self.extensionStart = start
         self.extensionEnd = end
+        self.startSector = end
 
     def _createLogicalPartition(self, device, number, partition):
         if self.extensionStart == -1:
             self.log.error("Creating a logical partition without an extended partition")
             raise SystemError("Logical partitions require extended partitions")
-        requestedPercent = self._getRequestedPercentage(partition[2])
-        start = self.extensionStart
-        end = start + requestedPercent
+        #Each logical partition is preceded by its own boot record
+        #  so leave an aligned gap in front of it
+        start = self.extensionStart + self.PART_ALIGNMENT
+        end = start + self._getRequestedSectors(partition[2])
         if end > self.extensionEnd:
-            self.log.warning("Logical partition was truncated, %d%% beyond the extended partition", self.extensionEnd - end)
+            self.log.warning("Logical partition was truncated, %d sectors beyond the extended partition", end - self.extensionEnd)
             end = self.extensionEnd
+        if start >= end:
+            raise ValueError("No space left in the extended partition")
         self._createNextPartition(
             device, number, 'logical', partition, start, end)
         self.extensionStart = end
@@ -218,14 +259,8 @@ class SystemBuildMsdosPartitions(CsmakeModule):
         fulldevstring = device
         fullpartid = diskFstabId
         if number > 0:
-            partsep = ''
-            if 'loop' in device:
-                partsep = 'p'
-            fulldevstring = "%s%s%d" % (device, partsep, number)
-            partsep = ''
-            if 'loop' in diskFstabId:
-                partsep = 'p'
-            fullpartid = "%s%s%d" % (diskFstabId, partsep, number)
+            fulldevstring = "%s%s%d" % (device, self.devicePartSep, number)
+            fullpartid = "%s%s%d" % (diskFstabId, self.fstabIdPartSep, number)
         if partFstabId is None:
             if '=' not in diskFstabId:
                 partFstabId = fullpartid
@@ -237,6 +272,29 @@ class SystemBuildMsdosPartitions(CsmakeModule):
             'device' : fulldevstring,
             'fstab-id' : partFstabId }
 
+    def _waitForDevices(self, devices):
+        #Returns True if all the devices exist within PART_DEVICE_TIMEOUT
+        deadline = time.time() + self.PART_DEVICE_TIMEOUT
+        while True:
+            missing = [ x for x in devices if not os.path.exists(x) ]
+            if len(missing) == 0:
+                return True
+            if time.time() >= deadline:
+                self.log.debug("Partition devices did not appear: %s", missing)
+                return False
+            time.sleep(0.1)
+            devices = missing
+
+    def _makeSwap(self, name, errors):
+        #Records failures in errors so it may be run from a worker thread
+        try:
+            subprocess.check_call(
+                ['sudo', 'mkswap', '-L', name, self.partEntry[name]['device']],
+                stdout=self.logOut,
+                stderr=self.logErr)
+        except Exception as e:
+            errors[name] = e
+
     def system_build(self, options):
         return self.build(options)
     def build(self, options):
@@ -245,7 +303,12 @@ class SystemBuildMsdosPartitions(CsmakeModule):
         return self._doPartitioning(options, False)
 
     def _doPartitioning(self, options, build):
+        #Output streams shared by every helper run for this disk
+        self.logOut = self.log.out()
+        self.logErr = self.log.err()
         self.swaps = []
+        self.customTypes = []
+        self.partedCommands = []
         system = options['system']
         diskname = options['disk-name']
         key = self._getEnvKey(system)
@@ -266,117 +329,94 @@ class SystemBuildMsdosPartitions(CsmakeModule):
         diskEntry['partitions'] = {}
         diskEntry['swaps'] = []
         self.partEntry = diskEntry['partitions']
+        #Loop devices number their partitions as <device>p<number>
+        self.devicePartSep = ''
+        if 'loop' in diskEntry['device']:
+            self.devicePartSep = 'p'
+        self.fstabIdPartSep = ''
+        if 'loop' in diskEntry['fstab-id']:
+            self.fstabIdPartSep = 'p'
         partitions=[]
         if build:
-            subprocess.check_call(
-                ['sudo', 'parted', '-s', diskEntry['device'], '--', 'mklabel', self.PART_TYPE],
-                stdout=self.log.out(),
-                stderr=self.log.err())
+            #The label is written by the same parted call that creates
+            #  the partitions
+            self.partedCommands.extend(['mklabel', self.PART_TYPE])
 
         #Get the sizes ready for creating partitions
         self.systemInstance = systemEntry['system']
         #parted on ubuntu14.04 is stupid...starting at 0 causes it to make a 1M
         #  partition...so what we do is start it at sector 2048
-        self.startPercent = 0
+        self.startSector = self.PART_ALIGNMENT
         self.disksize = diskEntry['size']
+        self.diskEnd = self.disksize // self.PART_SECTOR_SIZE \
+                           - self.PART_RESERVED_END
+        self.sizeCache = {}
         self.extensionStart = -1
         self.extensionEnd= -1
 
-        for key, value in options.iteritems():
-            if key.startswith('part_'):
-                name = key[5:]
-                partition = [name]
-                partition.extend(value.split(','))
-                partition = [ x.strip() for x in partition if len(x.strip()) > 0 ]
-                partitions.append( partition )
+        for key, value in options.items():
+            match = self.PART_OPTION_FORMAT.match(key)
+            if match is not None:
+                fields = [ x.strip() for x in value.split(',') ]
+                partitions.append(
+                    [ match.group(1) ] + [ x for x in fields if len(x) > 0 ] )
         self.log.devdebug("Processing partitions: %s", partitions)
-        partitions.sort(key=lambda x: x[1])
+        #Parse each order once, then sort and dispatch on the result
+        orderedPartitions = []
+        for part in partitions:
+            sortKey, kind = self._parsePartitionOrder(part[1])
+            orderedPartitions.append((sortKey, kind, part))
+        orderedPartitions.sort(key=lambda entry: entry[0])
         #NOTE: assuming and assigning part numbers based on p/e/l volume
         #      creation ordering in parted.
         #Consider that the partition number assumption could be checked
         #  by showing that the parition number did not exist, and then
         #  after creating the partition, it does exist.
+        creators = {
+            'P' : self._createPrimaryPartition,
+            'E' : self._createExtendedPartition,
+            'L' : self._createLogicalPartition }
         primary = 1
-        extended = ""
         logical = 5
-        for part in partitions:
+        for _, kind, part in orderedPartitions:
+            if kind is None:
+                self.log.error("The format of 'part_%s' option is incorrect", part[0])
+                self.log.error("   got: %s", part[1])
+                self.log.error("   format required: <n>, <ex>E or <ex>E:<part>L")
+                self.log.error("      e.g.: 2E:5L  where 2 is an extended partition")
+                self.log.failed()
+                return None
+            if kind != 'P' and not self.PART_LOGICAL_EXTENDED_ALLOWED:
+                self.log.error("Logical volumes are not allowed with type '%s'", self.PART_TYPE)
+                self.log.failed()
+                return None
+            if kind == 'L':
+                number = logical
+                logical += 1
+            else:
+                if primary > self.PART_PRIMARY_PARTITIONS:
+                    self.log.error("%s partition tables may only have %d primary and extended partitions", self.PART_TYPE, self.PART_PRIMARY_PARTITIONS)
+                    self.log.error("   However, part_%s defines partition %d", part[0], primary)
+                    self.log.failed()
+                    return None
+                if kind == 'E' and self.extensionStart != -1:
+                    self.log.error("The disk can only have one extended partition")
+                    self.log.error("   part_%s specified a second extended partition", part[0] )
+                    self.log.failed()
+                    return None
+                number = primary
+                primary += 1
             try:
-                if part[1][-1] == 'L':
-                    if not self.PART_LOGICAL_EXTENDED_ALLOWED:
-                        self.log.error("Logical volumes are not allowed with type '%s'", self.PART_TYPE)
-                        self.log.failed()
-                        return None
-                    if len(part[1]) < 4 or part[1][1] != 'E' or part[1][2] != ':':
-                        self.log.error("The format of 'part_%s' option is incorrect", part[0])
-                        self.log.error("   got: %s", part[1])
-                        self.log.error("   format required: <ex>:<part>L")
-                        self.log.error("      e.g.: 2:5L  where 2 is an extended partition")
-                        self.log.failed()
-                        return None
-                    if build:
-                        self._createLogicalPartition(
-                            diskEntry['device'],
-                            logical,
-                            part )
-                    self._createPartitionEntry(
-                        part,
-                        logical,
-                        diskEntry['device'],
-                        diskEntry['fstab-id'])
-                    logical += 1
-
-                elif part[1][-1] == 'E':
-                    if not self.PART_LOGICAL_EXTENDED_ALLOWED:
-                        self.log.error("Logical volumes are not allowed with type '%s'", self.PART_TYPE)
-                        self.log.failed()
-                        return None
-                    if primary > self.PART_PRIMARY_PARTITIONS:
-                        self.log.error("%s partition tables may only have 4 primary and extended partitions", self.PART_TYPE)
-                        self.log.error("   However, part_%s defines a 5th partition", part[0])
-                        self.log.failed()
-                        return None
-                    if len(part[1]) < 2:
-                        self.log.error("The format of 'part_%s' option is incorrect", part[0])
-                        self.log.error("    got: %s", part[1])
-                        self.log.error("    format required: <ex>E")
-                        self.log.error("       e.g.: 3E")
-                        self.log.failed()
-                        return None
-                    if self.extensionStart != -1:
-                        self.log.error("The disk can only have one extended partition")
-                        self.log.error("   part_%s specified a second extended partition", part[0] )
-                        self.log.failed()
-                        return None
-                    if build:
-                        self._createExtendedPartition(
-                            diskEntry['device'],
-                            primary,
-                            part )
-                    self._createPartitionEntry(
-                        part,
-                        primary,
-                        diskEntry['device'],
-                        diskEntry['fstab-id'])
-                    extension = str(primary)
-                    primary += 1
-
-                else:
-                    if primary > self.PART_PRIMARY_PARTITIONS:
-                        self.log.error("%s partition tables may only have 4 primary and extended sections", self.PART_TYPE)
-                        self.log.error("   However, part_%s defines a 5th partition", part[0])
-                        self.log.failed()
-                        return None
-                    if build:
-                        self._createPrimaryPartition(
-                            diskEntry['device'],
-                            primary,
-                            part )
-                    self._createPartitionEntry(
-                        part,
-                        primary,
+                if build:
+                    creators[kind](
                         diskEntry['device'],
-                        diskEntry['fstab-id'])
-                    primary += 1
+                        number,
+                        part )
+                self._createPartitionEntry(
+                    part,
+                    number,
+                    diskEntry['device'],
+                    diskEntry['fstab-id'])
             except ValueError as v:
                 self.log.exception('Partition "%s" creation failed', part)
                 self.log.failed()
@@ -385,31 +425,55 @@ class SystemBuildMsdosPartitions(CsmakeModule):
                 self.log.exception('Partition "%s" shell call failed', part)
                 self.log.failed()
                 return None
-        result = subprocess.call(
-            ['sudo', 'partprobe', diskEntry['device']],
-            stdout=self.log.out(),
-            stderr=self.log.err())
-        if result != 0:
-            self.log.warning("Part probe failed")
-        result = subprocess.call(
-            ['sudo', 'udevadm', 'settle'],
-            stdout=self.log.out(),
-            stderr=self.log.err())
-        if result != 0:
-            self.log.warning("settle failed")
-        for partdev, partnum, partpartition in self.swaps:
+        #Nothing needs to be written or probed when reusing the disk
+        swapErrors = {}
+        if build:
             try:
-                if build:
-                    subprocess.check_call(
-                        ['sudo', 'mkswap', '-L',
-                           partpartition[0],
-                           self.partEntry[partpartition[0]]['device']],
-                        stdout=self.log.out(),
-                        stderr=self.log.err())
-                self.partEntry[partpartition[0]]['fstab-id'] = 'LABEL=%s' % partpartition[0]
-                diskEntry['swaps'].append((partpartition[0], self.partEntry[partpartition[0]]))
-            except:
-                self.log.exception("The swap, '%s', could not be initialized", partpartition[0])
+                subprocess.check_call(
+                    ['sudo', 'parted', '-s', '-a', 'optimal',
+                      diskEntry['device'], '--'] + self.partedCommands,
+                    stdout=self.logOut,
+                    stderr=self.logErr )
+            except subprocess.CalledProcessError as cpe:
+                self.log.exception('Partitioning disk "%s" failed', diskname)
+                self.log.failed()
+                return None
+            if len(self.customTypes) > 0:
+                self._commitPartitionTypes(diskEntry['device'], self.customTypes)
+            result = subprocess.call(
+                ['sudo', 'partprobe', diskEntry['device']],
+                stdout=self.logOut,
+                stderr=self.logErr)
+            if result != 0:
+                self.log.warning("Part probe failed")
+            #The nodes can exist before udev has handled the change
+            #  events: closing the disk makes udev re-read the partition
+            #  table, which briefly removes and re-adds every partition
+            #  node.  So always settle udev after the nodes show up.
+            self._waitForDevices(
+                [ entry['device'] for entry in self.partEntry.values() ])
+            result = subprocess.call(
+                ['sudo', 'udevadm', 'settle',
+                  '--timeout=%d' % self.PART_SETTLE_TIMEOUT],
+                stdout=self.logOut,
+                stderr=self.logErr)
+            if result != 0:
+                self.log.warning("settle failed")
+
+            #Swap partitions are independent so initialize them concurrently
+            self.systemInstance._runSudoTasks(
+                [ (self._makeSwap, (name, swapErrors))
+                  for name in self.swaps ],
+                self.log )
+        for name in self.swaps:
+            if name in swapErrors:
+                self.log.error(
+                    "The swap, '%s', could not be initialized: %s",
+                    name,
+                    str(swapErrors[name]) )
+                continue
+            self.partEntry[name]['fstab-id'] = 'LABEL=%s' % name
+            diskEntry['swaps'].append((name, self.partEntry[name]))
 
         self.log.passed()
         return self.partEntry
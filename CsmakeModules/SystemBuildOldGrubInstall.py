@@ -15,7 +15,8 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 # </copyright>
 from CsmakeModules.SystemBuildGrubInstall import SystemBuildGrubInstall
-import glob
+import errno
+import fnmatch
 import os
 import os.path
 import stat
@@ -32,10 +33,10 @@ class SystemBuildOldGrubInstall(SystemBuildGrubInstall):
            system - The SystemBuild system to make bootable
            kernel - (OPTIONAL) name of the kernel bootstrap (glob format)
                     Default: vmlinuz*
-                    Module will fail if more than one match exists
+                    Module will fail unless exactly one match exists
            initrd - (OPTIONAL) name of the initial filesystem (glob format)
                     Default: initramfs*
-                    Module will fail if more than one match exists
+                    Module will fail unless exactly one match exists
            params - (OPTIONAL) kernel parameters to add
                     Default: <nothing>
        Note:
@@ -74,14 +75,54 @@ title CentOS
 
     ETC_MTAB_FILE = "etc/mtab"
 
+    def _createDeviceNodes(self, devNodes):
+        #devNodes is a list of (path, rdev) for the block devices to create
+        #Record them all first so cleanup covers a partially failed run
+        self._createdDevEntries.extend([ path for path, _ in devNodes ])
+        if len(devNodes) == 0:
+            return
+        if os.geteuid() == 0:
+            for path, rdev in devNodes:
+                os.mknod(path, 0o600 | stat.S_IFBLK, rdev)
+            return
+        #Make all the nodes with a single sudo call
+        command = [ 'sudo', 'sh', '-c',
+            'while [ $# -gt 0 ]; do mknod "$1" b "$2" "$3" || exit 1; shift 3; done',
+            'mknod' ]
+        for path, rdev in devNodes:
+            command.extend(
+                [ path, str(os.major(rdev)), str(os.minor(rdev)) ] )
+        subprocess.check_call(
+            command,
+            stdout=self.log.out(),
+            stderr=self.log.err() )
+
+    def _removeFiles(self, paths):
+        if len(paths) == 0:
+            return
+        if os.geteuid() == 0:
+            for path in paths:
+                try:
+                    os.unlink(path)
+                except OSError as e:
+                    if e.errno != errno.ENOENT:
+                        self.log.warning("Could not remove %s: %s", path, str(e))
+            return
+        subprocess.call(
+            [ 'sudo', 'rm', '-f' ] + list(paths),
+            stdout = self.log.out(),
+            stderr = self.log.err())
+
     def _prepareForGrubInstall(self):
         #Does /dev/hd* exist?
-        chosenpath = '/dev/hd'
+        #  Read /dev once and check names against it
+        devNames = set(os.listdir('/dev'))
+        chosenprefix = 'hd'
         currentdrive = 'z'
         currentgrub = 0
-        if os.path.exists('/dev/hda'):
-            if not os.path.exists('/dev/sda'):
-                chosenpath = '/dev/sd'
+        if 'hda' in devNames:
+            if 'sda' not in devNames:
+                chosenprefix = 'sd'
 
         self._oldGrubDiskMappings = {}
         self._deviceMapEntries = []
@@ -92,13 +133,15 @@ title CentOS
         self._systemPathToMtab = None
         self._systemPathToMap = None
 
+        devNodes = []
         try:
             #Create fake dev entries that legacy grub can handle pointing
             # to the system we're building.
             for name, disk in self.systemEntry['disks'].iteritems():
                 if disk['real']:
-                    currentdev = '%s%s' % (chosenpath, currentdrive)
-                    if os.path.exists(currentdev):
+                    currentname = '%s%s' % (chosenprefix, currentdrive)
+                    currentdev = '/dev/%s' % currentname
+                    if currentname in devNames:
                         errormsg = "%s is required for use to install grub, but already exists on the system" % currentdev
                         self.log.error(errormsg)
                         raise ValueError(errormsg)
@@ -107,13 +150,7 @@ title CentOS
                         errormsg = "%s is not a block device" % disk['device']
                         self.log.error(errormsg)
                         raise ValueError(errormsg)
-                    devmajor = os.major(devstat.st_rdev)
-                    devminor = os.minor(devstat.st_rdev)
-                    self._createdDevEntries.append(currentdev)
-                    subprocess.check_call(
-                        [ 'sudo', 'mknod', currentdev, 'b', str(devmajor), str(devminor) ],
-                        stdout=self.log.out(),
-                        stderr=self.log.err() )
+                    devNodes.append((currentdev, devstat.st_rdev))
                     self._oldGrubDiskMappings[disk['device']] = currentdev
                     self._deviceMapEntries.append(('hd%d'%currentgrub, currentdev))
                     for name, part in disk['partitions'].iteritems():
@@ -123,20 +160,13 @@ title CentOS
                             errormsg = "%s is not a block device" % part['device']
                             self.log.error(errormsg)
                             raise ValueError(errormsg)
-                        partmajor = os.major(partstat.st_rdev)
-                        partminor = os.minor(partstat.st_rdev)
-                        self._createdDevEntries.append(currentPart)
-                        subprocess.check_call(
-                            [ 'sudo', 'mknod' , currentPart, 'b', str(partmajor), str(partminor) ],
-                            stdout=self.log.out(),
-                            stderr=self.log.err() )
+                        devNodes.append((currentPart, partstat.st_rdev))
                         self._oldGrubDiskMappings[part['device']] = currentPart
                     currentgrub += 1
                     currentdrive = chr(ord(currentdrive) - 1)
+            self._createDeviceNodes(devNodes)
             for mountpt, device, fstype, fstabid in self.systemEntry['filesystem'].values():
-                mtabDevice = device
-                if mtabDevice in self._oldGrubDiskMappings:
-                    mtabDevice = self._oldGrubDiskMappings[mtabDevice]
+                mtabDevice = self._oldGrubDiskMappings.get(device, device)
                 self._mtabEntries.append("%s %s %s rw 0 0" % (
                     mtabDevice,
                     mountpt,
@@ -148,17 +178,28 @@ title CentOS
             self._systemPathToEtc, _ = os.path.split(
                 self._systemPathToMtab )
 
-            self._ensureDirectoryExists(self._systemPathToMtab)
-            self._etcdirmask = self._sudo_change_file_perms(
-                self._systemPathToEtc, '777')
+            mtabContents = '\n'.join(self._mtabEntries) + '\n'
+            #Rebuilds of the same system usually produce the same mtab
+            #  so leave it (and the permissions) alone in that case
             try:
-                self._mtabfilemask = self._sudo_change_file_perms(
-                    self._systemPathToMtab, '666')
-            except OSError:
-                self._mtabfilemask = '664'
+                with open(self._systemPathToMtab) as mtab:
+                    if mtab.read() == mtabContents:
+                        return
+            except (IOError, OSError):
+                pass
+
+            self._ensureDirectoryExists(self._systemPathToMtab)
+            permChanges = [(self._systemPathToEtc, '777')]
+            if os.path.exists(self._systemPathToMtab):
+                permChanges.append((self._systemPathToMtab, '666'))
+            oldMasks = self._sudo_change_files_perms(permChanges)
+            self._etcdirmask = oldMasks[0]
+            self._mtabfilemask = '664'
+            if len(oldMasks) > 1:
+                self._mtabfilemask = oldMasks[1]
 
             with open(self._systemPathToMtab, 'w') as mtab:
-                mtab.write('\n'.join(self._mtabEntries))
+                mtab.write(mtabContents)
 
         except:
             self._cleanUpPostGrubInstall()
@@ -167,34 +208,20 @@ title CentOS
     def _cleanUpPostGrubInstall(self):
         #Undo fake [hs]d* files
         self.log.debug("Cleaning up dev entries: %s", str(self._createdDevEntries))
-        for devfile in self._createdDevEntries:
-            subprocess.call(
-                [ 'sudo', 'rm', '-f', devfile ],
-                stdout = self.log.out(),
-                stderr = self.log.err())
-
-        #XXX: Revisit - ensure cleanup happens
-        return
-
-        #Undo mtab
-        if self._systemPathToMtab is not None:
-            subprocess.call(
-                [ 'sudo', 'rm', '-f', self._systemPathToMtab ],
-                stdout = self.log.out(),
-                stderr = self.log.err() )
-            with open(self._systemPathToMtab, 'w') as mtab:
-                mtab.write('')
-        if self._mtabfilemask is not None:
-            self._sudo_change_file_perms(self._systemPathToMtab, self._mtabfilemask)
+        self._removeFiles(self._createdDevEntries)
+
+        #Put back the permissions opened up to write mtab
+        #  mtab and device.map themselves are left in the system
+        permChanges = []
+        if self._mtabfilemask is not None \
+               and os.path.exists(self._systemPathToMtab):
+            permChanges.append((self._systemPathToMtab, self._mtabfilemask))
         if self._etcdirmask is not None:
-            self._sudo_change_file_perms(self._systemPathToEtc, self._etcdirmask)
-
-        #Remove device.map file
-        if self._systemPathToMap is not None:
-            subprocess.call(
-                [ 'sudo', 'rm', '-f', self._systemPathToMap ],
-                stdout = self.log.out(),
-                stderr = self.log.err() )
+            permChanges.append((self._systemPathToEtc, self._etcdirmask))
+        if len(permChanges) != 0:
+            self._sudo_change_files_perms(permChanges)
+        self._mtabfilemask = None
+        self._etcdirmask = None
 
     def _generateGrubConfig(self):
         #Write out a grub.conf
@@ -213,23 +240,24 @@ title CentOS
         self._ensureDirectoryExists(self._systemPathToMap)
 
         mapEntries = []
-        grubRootDrive = "(hd%d)" % self.systemDeviceInfo['disk']['number']
-        grubRoot = grubRootDrive.rstrip(')')
+        diskNumber = self.systemDeviceInfo['disk']['number']
+        grubRootDrive = "(hd%d)" % diskNumber
 
-        mappedSystemDevice = self.systemDevice
-        if self.systemDevice in self._oldGrubDiskMappings:
-            mappedSystemDevice = self._oldGrubDiskMappings[self.systemDevice]
+        mappedSystemDevice = self._oldGrubDiskMappings.get(
+            self.systemDevice, self.systemDevice)
         mapEntries.append( (
             grubRootDrive,
             mappedSystemDevice ) )
 
+        partitionSuffix = ''
         if self.systemDeviceInfo['partition'] is not None:
-            grubRoot += ',%d)' % (self.systemDeviceInfo['partition']['number'] - 1)
-        else:
-            grubRoot += ')'
+            partitionSuffix = ',%d' % (self.systemDeviceInfo['partition']['number'] - 1)
+
+        bootPath = '/boot'
+        if self.systemPathToSystemDevice.endswith('boot'):
+            bootPath = ''
 
-        if not self.systemPathToSystemDevice.endswith('boot'):
-            grubRoot += '/boot'
+        grubRoot = "(hd%d%s)%s" % (diskNumber, partitionSuffix, bootPath)
 
         #We just ensured that grub's root will be in the right place for boot
         #so, create a localBootRoot path to help us locally, but grub paths
@@ -237,63 +265,52 @@ title CentOS
         localBootRoot = os.path.join(self.systemPartition, 'boot')
 
         #Find the names of the kernel and initrd (assuming under <root>/boot)
+        #  from a single listing of the boot directory
+        bootfiles = os.listdir(localBootRoot)
         kernel = 'vmlinuz*'
         if 'kernel' in self.options:
             kernel = self.options['kernel']
-        bootentries = glob.glob(os.path.join(
-            localBootRoot,
-            kernel))
-        if len(bootentries) > 1:
-            self.log.error("Searching for kernel file '%s' found multiple entries: %s", kernel, ', '.join(bootentries))
+        bootentries = fnmatch.filter(bootfiles, kernel)
+        if len(bootentries) != 1:
+            self.log.error("Searching for kernel file '%s' found %d entries: %s", kernel, len(bootentries), ', '.join(bootentries))
             return False
-        kernelfile = os.path.relpath(bootentries[0], localBootRoot).strip('.')
-        if not kernelfile.startswith('/'):
-           kernelfile = '/' + kernelfile
-        
+        kernelfile = '/' + bootentries[0]
+
         initrd = 'initramfs*'
         if 'initrd' in self.options:
             initrd = self.options['initrd']
-        bootentries = glob.glob(os.path.join(
-            localBootRoot,
-            initrd))
-        if len(bootentries) > 1:
-            self.log.error("Searching for initrd file '%s' found multiple entries: %s", initrd, ', '.join(bootentries))
+        bootentries = fnmatch.filter(bootfiles, initrd)
+        if len(bootentries) != 1:
+            self.log.error("Searching for initrd file '%s' found %d entries: %s", initrd, len(bootentries), ', '.join(bootentries))
             return False
-        initrdfile = os.path.relpath(bootentries[0], localBootRoot).strip('.')
-        if not initrdfile.startswith('/'):
-            initrdfile = '/' + initrdfile
+        initrdfile = '/' + bootentries[0]
 
         kernelParams = ''
         if 'params' in self.options:
             kernelParams = self.options['params']
 
-        dirToConfig, _ = os.path.split(systemPathToConfig)
         self._ensureDirectoryExists(systemPathToConfig)
 
-        self._grubdirmask = self._sudo_change_file_perms(dirToConfig, '777')
-        self._conffilemask = None
-        if os.path.exists(systemPathToConfig):
-            self._conffilemask = self._sudo_change_file_perms(systemPathToConfig, '666')
         #Write out the config file
-        with open(systemPathToConfig,'w') as cfg:
-            cfg.write(self.BOILERPLATE_GRUB_CONF % (
+        if not self._writeSystemFile(
+            systemPathToConfig,
+            self.BOILERPLATE_GRUB_CONF % (
                 grubRoot,
                 kernelfile,
                 self.rootTabId,
                 kernelParams,
-                initrdfile ) )
+                initrdfile ) ):
+            self.log.failed()
+            return False
 
         #Generate the map information
-        with open(self._systemPathToMap, 'w') as cfg:
-            for entry in mapEntries:
-                cfg.write("%s\t%s\n" % entry)
-
-        if self._conffilemask is not None:
-            self._sudo_change_file_perms(systemPathToConfig, self._conffilemask)
-        self._sudo_change_file_perms(dirToConfig, self._grubdirmask)
+        if not self._writeSystemFile(
+            self._systemPathToMap,
+            ''.join([ "%s\t%s\n" % entry for entry in mapEntries ]) ):
+            self.log.failed()
+            return False
 
         #Transition the system device to the fake device
-        if self.systemDevice in self._oldGrubDiskMappings:
-            self.systemDevice = self._oldGrubDiskMappings[self.systemDevice]
+        self.systemDevice = mappedSystemDevice
         
         return True